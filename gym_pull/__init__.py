@@ -49,7 +49,7 @@ gym.envs.registration.env_id_re = gym_pull.envs.registration.env_id_re
 # >>>>>>>>> START changes >>>>>>>>>>>>>>>>>>>>>>>>
 logger.setLevel(logging.INFO)
 from gym_pull.envs import list
-from gym_pull.package import pull
+from gym_pull.package import gc, pull
 
 __all__ = ["Env", "Space", "Wrapper", "list", "make", "pull", "spec", "upload"]
 # <<<<<<<<< END changes <<<<<<<<<<<<<<<<<<<<<<<<<<
@@ -1,4 +1,6 @@
-from gym_pull.package.manager import load_user_envs, pull
+import os
 
-# Loading user environments
-load_user_envs()
+from gym_pull.package.manager import gc, load_user_envs, pull
+
+# Loading user environments (GYM_PULL_DEFER_GC=0 removes broken packages during import instead of on exit)
+load_user_envs(defer_gc=os.environ.get('GYM_PULL_DEFER_GC', '1') != '0')
@@ -1,5 +1,8 @@
+import atexit
+import binascii
 import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
@@ -27,10 +30,22 @@ class PackageManager(object):
         self.user_packages = {}
         self.cache_path = os.path.join(gym_abs_path, 'envs', user_env_cache_name)
         self.cache_needs_update = False
+        self.installed_packages = {}
+        self.stale_packages = set()
+        self.missing_packages = set()
+        self.failed_packages = set()
+        self.gc_scheduled = False
 
-    def load_user_envs(self):
-        """ Loads downloaded user envs from filesystem cache on `import gym` """
+    def load_user_envs(self, defer_gc=True):
+        """
+        Loads downloaded user envs from filesystem cache on `import gym`
+        Args:
+            defer_gc: if True, broken packages are not uninstalled during startup. They are removed (with the cache
+                      compaction) by `gym_pull.gc()`, or automatically when the main process exits.
+                      Set the environment variable GYM_PULL_DEFER_GC=0 to remove them during `import gym_pull` instead.
+        """
         installed_packages = self._list_packages()
+        self.installed_packages = installed_packages
 
         # Tagging core envs
         gym_package = 'gym ({})'.format(installed_packages['gym']) if 'gym' in installed_packages else 'gym'
@@ -47,11 +62,37 @@ class PackageManager(object):
                 user_package, registered_envs = self._load_package(line.rstrip('\n'), installed_packages)
                 if logger.level <= logging.DEBUG:
                     logger.debug('Installed %d user environments from package "%s"', len(registered_envs), user_package['name'])
-        if self.cache_needs_update:
-            self._update_cache()
         if len(self.env_ids) > 0:
             logger.info('Found and registered %d user environments.', len(self.env_ids))
 
+        # Removing broken packages and compacting cache
+        # Packages that pip already failed to uninstall are only retried by an explicit `gym_pull.gc()`
+        failed_packages = self.stale_packages & self.failed_packages
+        if len(failed_packages) > 0:
+            logger.warn('Unable to uninstall the broken packages: %s. Run `gym_pull.gc()` to try again.',
+                        ', '.join(sorted(failed_packages)))
+        if len(self.stale_packages - failed_packages) == 0 and not self.cache_needs_update:
+            return
+        if not defer_gc:
+            self._collect_garbage(installed_packages, retry_failed=False)
+        elif not self.gc_scheduled and multiprocessing.current_process().name == 'MainProcess':
+            # Child processes (e.g. multiprocessing workers) would race each other on pip and on the cache file
+            if len(self.stale_packages - failed_packages) > 0:
+                logger.info('Found %d broken user packages. They will be uninstalled on exit, or run `gym_pull.gc()` '
+                            'to uninstall them now.', len(self.stale_packages - failed_packages))
+            atexit.register(self._deferred_gc)
+            self.gc_scheduled = True
+
+    def gc(self):
+        """
+        Uninstalls broken user packages, deregisters the environments of stale and uninstalled packages,
+        and compacts the cache file
+        Returns:
+            the sorted list of package names that were removed
+        """
+        self.installed_packages = self._list_packages()
+        return self._collect_garbage(self.installed_packages)
+
     def pull(self, source=''):
         """
         Downloads and registers a user environment from a git repository
@@ -91,6 +132,7 @@ where username is a GitHub username, repository is the name of a GitHub reposito
 
         # Detecting new and upgraded packages
         packages_after = self._list_packages()
+        self.installed_packages = packages_after
         for package_name in packages_after:
             package_version = packages_after[package_name]
             if package_name not in packages_before:
@@ -115,9 +157,8 @@ where username is a GitHub username, repository is the name of a GitHub reposito
                             package_name, source, self.user_packages[package_name]['source'])
                 self._deregister_envs_from_source(source)
                 self._deregister_envs_from_source(self.user_packages[package_name]['source'])
-                self._run_cmd('{} uninstall -y {}'.format(pip_exec, package_name))
-                del self.user_packages[package_name]
-                self._update_cache()
+                self.stale_packages.add(package_name)
+                self._collect_garbage(packages_after)
                 return
 
         # Detecting if already up-to-date
@@ -130,7 +171,7 @@ where username is a GitHub username, repository is the name of a GitHub reposito
 
         # Loading new packages
         new_envs = set([])
-        uninstall_packages = []
+        uninstall_packages = set([])
         for package_name in modified_packages:
             json_line = json.dumps({'name': package_name, 'version': packages_after[package_name], 'source': source})
             user_package, registered_envs = self._load_package(json_line, packages_after)
@@ -139,18 +180,18 @@ where username is a GitHub username, repository is the name of a GitHub reposito
                     if len(uninstall_packages) == 0:    # We don't need to repeat the message multiple times
                         logger.warn('This package does not respect the naming convention and will be uninstalled to avoid conflicts. '
                                     'Expected user environment to start with "{}/", but got "{}" instead.'.format(username, new_env))
-                    uninstall_packages.append(package_name)
+                    uninstall_packages.add(package_name)
             new_envs = new_envs | registered_envs
 
         # Removing packages and deregistering envs if they don't respect naming convention
         if len(uninstall_packages) > 0:
             self._deregister_envs_from_source(source)
-            for package_name in uninstall_packages:
-                self._run_cmd('{} uninstall -y {}'.format(pip_exec, package_name))
-            return
+            self.stale_packages.update(uninstall_packages)
 
-        # Updating cache
-        self._update_cache()
+        # Removing broken packages and updating cache
+        self._collect_garbage(packages_after, updated_packages=modified_packages)
+        if len(uninstall_packages) > 0:
+            return
 
         # Displaying results
         logger.info('--------------------------------------------------')
@@ -175,6 +216,75 @@ where username is a GitHub username, repository is the name of a GitHub reposito
             registry.deregister(env_name)
             self.env_ids.remove(env_name.lower())
 
+    def _deregister_envs_from_packages(self, package_names):
+        envs_to_remove = []
+        for spec in registry.all():
+            # spec.package is 'package_name (version)'
+            if getattr(spec, 'package', '').split(' ')[0] in package_names:
+                envs_to_remove.append(spec.id)
+        for env_name in envs_to_remove:
+            registry.deregister(env_name)
+            self.env_ids.discard(env_name.lower())
+
+    def _uninstall_packages(self, package_names):
+        """ Uninstalls all the packages with a single pip command """
+        if len(package_names) == 0:
+            return 0
+        return self._run_cmd('{} uninstall -y {}'.format(pip_exec, ' '.join(package_names)))
+
+    def _collect_garbage(self, installed_packages, updated_packages=(), retry_failed=True):
+        """
+        Removes stale packages (broken or no longer installed) and rewrites the cache once
+        Args:
+            installed_packages: the packages currently installed (as returned by _list_packages)
+            updated_packages: the packages whose in-memory entry must replace the one in the cache file
+            retry_failed: if False, packages that pip previously failed to uninstall are left in place
+        """
+        removed_packages = self.stale_packages | self.missing_packages
+        for package_name in self.user_packages:
+            if package_name not in installed_packages:
+                removed_packages.add(package_name)
+
+        # Keeping packages in stale_packages (and in the cache) if pip fails, and flagging them in the cache
+        # so they are not retried automatically on every exit
+        skipped_packages = set() if retry_failed else self.stale_packages & self.failed_packages
+        uninstall_packages = sorted([name for name in self.stale_packages - skipped_packages if name in installed_packages])
+        failed_packages = set()
+        if self._uninstall_packages(uninstall_packages) != 0:
+            logger.warn('Unable to uninstall the packages: %s. They will no longer be uninstalled automatically. '
+                        'Run `gym_pull.gc()` to try again.', ', '.join(uninstall_packages))
+            failed_packages = set(uninstall_packages)
+            self.failed_packages |= failed_packages
+        removed_packages -= failed_packages | skipped_packages
+        self.stale_packages = failed_packages | skipped_packages
+        self.missing_packages = set()
+
+        self._deregister_envs_from_packages(removed_packages)
+        for package_name in removed_packages:
+            self.user_packages.pop(package_name, None)
+
+        # Re-reading the cache, as other processes might have pulled packages since it was loaded
+        cached_packages = self._read_cache()
+        for package_name in removed_packages:
+            cached_packages.pop(package_name, None)
+        for package_name in updated_packages:
+            if package_name in self.user_packages and package_name not in self.stale_packages:
+                cached_packages[package_name] = self.user_packages[package_name]
+        for package_name in failed_packages:
+            if package_name in cached_packages:
+                cached_packages[package_name]['uninstall_failed'] = True
+        self._update_cache(cached_packages)
+
+        if len(removed_packages) > 0:
+            logger.info('Removed %d stale user packages: %s', len(removed_packages), ', '.join(sorted(removed_packages)))
+        return sorted(removed_packages)
+
+    def _deferred_gc(self):
+        self.gc_scheduled = False
+        if len(self.stale_packages - self.failed_packages) > 0 or self.cache_needs_update:
+            # Re-using the packages listed on load (or by the last pull / gc), to avoid running pip on exit
+            self._collect_garbage(self.installed_packages, retry_failed=False)
+
     def _list_packages(self):
         packages = {}
         # package_name before first (, package version before space, comma, or ending parenthese
@@ -192,10 +302,39 @@ where username is a GitHub username, repository is the name of a GitHub reposito
         shutil.rmtree(os.path.dirname(temp_file))
         return packages
 
-    def _update_cache(self):
-        with open(self.cache_path, 'w') as cache:
-            for package_name in self.user_packages:
-                cache.write('{}\n'.format(json.dumps(self.user_packages[package_name])))
+    def _read_cache(self):
+        """ Returns the valid entries of the cache file (invalid lines are dropped) """
+        cached_packages = {}
+        if not os.path.isfile(self.cache_path):
+            return cached_packages
+        with open(self.cache_path) as cache:
+            for line in cache:
+                try:
+                    user_package = json.loads(line.rstrip('\n'))
+                except ValueError:
+                    continue
+                if isinstance(user_package, dict) and 'name' in user_package:
+                    cached_packages[user_package['name']] = user_package
+        return cached_packages
+
+    def _update_cache(self, user_packages):
+        # Writing to a temp file in the same directory, then renaming it, so the cache is never partially written
+        # The temp file is created with the default permissions (i.e. the umask applies), unlike tempfile.mkstemp()
+        temp_path = '{}.{}.tmp'.format(self.cache_path, binascii.hexlify(os.urandom(8)).decode('ascii'))
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, 'w') as cache:
+                for package_name in user_packages:
+                    cache.write('{}\n'.format(json.dumps(user_packages[package_name])))
+            if os.path.isfile(self.cache_path):
+                shutil.copymode(self.cache_path, temp_path)
+            if os.name == 'nt' and os.path.isfile(self.cache_path):     # os.rename() does not overwrite on Windows
+                os.remove(self.cache_path)
+            os.rename(temp_path, self.cache_path)
+        except Exception:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            raise
         self.cache_needs_update = False
 
     def _load_package(self, json_line, installed_packages):
@@ -211,6 +350,8 @@ where username is a GitHub username, repository is the name of a GitHub reposito
             user_package = {}
 
         package_name = user_package['name'] if 'name' in user_package else None
+        if package_name is not None and user_package.get('uninstall_failed', False):
+            self.failed_packages.add(package_name)
         module_name = package_name.replace('-', '_') if package_name is not None else ''
         envs_before = set(registry.list())
 
@@ -221,6 +362,7 @@ where username is a GitHub username, repository is the name of a GitHub reposito
             return {}, set([])
         elif package_name not in installed_packages:
             self.cache_needs_update = True
+            self.missing_packages.add(package_name)
             logger.warn('The package "%s" does not seem to be installed anymore. User environments from this '
                         'package will not be registered, and the package will no longer be loaded on `import gym`', package_name)
         elif module_name in sys.modules:
@@ -234,19 +376,18 @@ where username is a GitHub username, repository is the name of a GitHub reposito
                                 module_name, package_name, installed_packages[package_name])
                     traceback.print_exc(file=sys.stdout)
                     sys.stdout.write('\n')
-                    self._run_cmd('{} uninstall -y {}'.format(pip_exec, package_name))
+                    self.stale_packages.add(package_name)
         else:
             try:
                 __import__(module_name)
             except ImportError:
                 if 'gym' in package_name:   # To avoid uninstalling failing dependencies
-                    self.cache_needs_update = True
                     logger.warn('Unable to import the module "%s" from package "%s" (%s). This is usually caused by a '
                                 'invalid pip package. The package will be uninstalled and no longer be loaded on `import gym`.\n',
                                 module_name, package_name, installed_packages[package_name])
                     traceback.print_exc(file=sys.stdout)
                     sys.stdout.write('\n')
-                    self._run_cmd('{} uninstall -y {}'.format(pip_exec, package_name))
+                    self.stale_packages.add(package_name)
 
         envs_after = set(registry.list())
         registered_envs = envs_after - envs_before
@@ -263,3 +404,4 @@ where username is a GitHub username, repository is the name of a GitHub reposito
 manager = PackageManager()
 pull = manager.pull
 load_user_envs = manager.load_user_envs
+gc = manager.gc